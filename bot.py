@@ -1,7 +1,11 @@
 # pyright: reportMissingImports=false
-import os, io, logging, json, time, asyncio, uuid
-from dataclasses import dataclass, field
-from typing import Tuple, List, Dict
+import os, io, logging, time, asyncio, uuid, math, hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field, replace
+from functools import lru_cache, partial
+from typing import Tuple, List, Dict, Callable, Optional, Any
 from datetime import datetime, timezone
 
 from dotenv import load_dotenv
@@ -13,6 +17,31 @@ try:
 except ImportError as e:
     raise SystemExit("Pillow no instalado. pip install Pillow") from e
 
+# libvips (opcional): decodificación y LANCZOS con SIMD; si no está, se usa Pillow
+try:
+    import pyvips  # type: ignore[import-not-found]
+except (ImportError, OSError):
+    pyvips = None
+
+# libwebp directo (opcional, paquete 'webp'): la imagen se importa una vez a WebPPicture
+# y cada sonda solo cambia la configuración; si no está, se codifica con Pillow
+try:
+    import webp  # type: ignore[import-not-found]
+except ImportError:
+    webp = None
+
+# Redis (opcional): persiste las estadísticas entre reinicios si hay REDIS_URL
+try:
+    import redis.asyncio as aioredis  # type: ignore[import-not-found]
+except ImportError:
+    aioredis = None
+
+# uvloop (opcional, no existe en Windows): event loop más rápido para sockets y tareas
+try:
+    import uvloop  # type: ignore[import-not-found]
+except ImportError:
+    uvloop = None
+
 # Telegram
 from telegram import Update
 from telegram.constants import ChatMemberStatus
@@ -25,21 +54,47 @@ from telegram.error import TimedOut, NetworkError, RetryAfter, Conflict
 # HTTP async
 import aiohttp
 
+# JSON (orjson serializa directamente a bytes UTF-8)
+import orjson
+
 # Firebase Storage (GCS)
 from google.oauth2 import service_account
 from google.cloud import storage as gcs
+from google.api_core.exceptions import PreconditionFailed
 
 # -------- Config --------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise SystemExit("Falta BOT_TOKEN")
 
-TARGET_KB = int(os.getenv("TARGET_KB", "200"))
-MAX_DIM = int(os.getenv("MAX_DIMENSION", "1920"))
+@dataclass(frozen=True)
+class Cfg:
+    target_kb: int
+    max_dim: int
+
+# Inmutable: /settarget y /setmaxdim sustituyen el objeto entero, nunca lo mutan
+CFG = Cfg(target_kb=int(os.getenv("TARGET_KB", "200")), max_dim=int(os.getenv("MAX_DIMENSION", "1920")))
 MIN_Q, MAX_Q = 30, 90
+# method/effort de libwebp: las sondas solo estiman tamaño con el preset más rápido; la
+# salida se codifica una vez con el final (6 apenas reduce más que 4 y tarda el doble)
+PROBE_METHOD, FINAL_METHOD = 0, 4
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 ALLOWED_CHAT_ID = int(os.getenv("ALLOWED_CHAT_ID", "0"))
 ALBUM_TTL_SEC = float(os.getenv("ALBUM_TTL_SEC", "4.0"))
+WEBP_CACHE_SIZE = int(os.getenv("WEBP_CACHE_SIZE", "256"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "25")) * 1024 * 1024
+# Límites de memoria para álbumes en curso (Telegram manda como mucho 10 por álbum)
+MAX_ALBUMS, MAX_ALBUM_ITEMS = 64, 20
+# Por defecto cabe un álbum completo de 10 archivos al límite por archivo; MAX_ALBUM_MB lo fija a mano
+MAX_ALBUM_BYTES = int(os.getenv("MAX_ALBUM_MB", "0")) * 1024 * 1024 or 10 * MAX_UPLOAD_BYTES
+# Workers de codificación: las CPUs asignadas al proceso (en contenedores os.cpu_count()
+# devuelve las del host y sobresuscribe); ENCODE_WORKERS lo fija a mano
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "0")) or (
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+)
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL and aioredis is None:
+    raise SystemExit("REDIS_URL definido pero redis no instalado. pip install redis")
 
 API_DRAFTS_IMPORT_URL = os.getenv("API_DRAFTS_IMPORT_URL", "https://www.morrinashop.com/api/drafts/import")
 X_INGEST_TOKEN = os.getenv("X_INGEST_TOKEN") or os.getenv("INGEST_TOKEN")
@@ -56,7 +111,7 @@ if not (FIREBASE_PROJECT_ID and FIREBASE_STORAGE_BUCKET and SERVICE_ACCOUNT_JSON
     raise SystemExit("Faltan FIREBASE_PROJECT_ID/NEXT_PUBLIC_FIREBASE_PROJECT_ID, "
                      "FIREBASE_STORAGE_BUCKET/NEXT_PUBLIC_FIREBASE_STORAGE_BUCKET o SERVICE_ACCOUNT_JSON")
 
-creds = service_account.Credentials.from_service_account_info(json.loads(SERVICE_ACCOUNT_JSON))
+creds = service_account.Credentials.from_service_account_info(orjson.loads(SERVICE_ACCOUNT_JSON))
 gcs_client = gcs.Client(project=FIREBASE_PROJECT_ID, credentials=creds)
 bucket = gcs_client.bucket(FIREBASE_STORAGE_BUCKET)
 
@@ -67,6 +122,10 @@ logging.getLogger("telegram.ext").setLevel(logging.INFO)
 log = logging.getLogger("ingest-bot")
 START_TIME = datetime.now(timezone.utc)
 stats = {"processed": 0, "saved_bytes": 0}
+# La codificación WebP es CPU-bound: se ejecuta en procesos aparte para no bloquear el loop
+EXECUTOR = ProcessPoolExecutor(max_workers=ENCODE_WORKERS)
+# Subidas a GCS: 8 hilos que comparten la AuthorizedSession (y su token) de gcs_client
+UPLOAD_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="gcs")
 
 # Log de configuración efectiva
 log.info(f"GCP Project={FIREBASE_PROJECT_ID}, Bucket={FIREBASE_STORAGE_BUCKET}, SA={creds.service_account_email}")
@@ -85,63 +144,297 @@ async def is_authorized(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
         return False
     return False
 
-def to_webp_optimized(img_bytes: bytes, target_kb: int, max_dim: int) -> Tuple[io.BytesIO, int]:
-    im = Image.open(io.BytesIO(img_bytes))
-    im = ImageOps.exif_transpose(im)
-    if im.mode not in ("RGB", "RGBA"):
+def _pick_quality(probe_kb: Callable[[int], float], target_kb: int) -> int:
+    # Extremos primero: si MAX_Q ya cabe (foto pequeña) o MIN_Q no cabe, no hay búsqueda
+    kb_hi = probe_kb(MAX_Q)
+    if kb_hi <= target_kb:
+        return MAX_Q
+    kb_lo = probe_kb(MIN_Q)
+    if kb_lo >= target_kb or kb_hi <= kb_lo:
+        return MIN_Q
+    # Tamaño ~ log-lineal en la calidad: las dos sondas bastan para estimar la
+    # calidad objetivo; solo la elegida se codifica con el preset lento
+    a = (math.log(kb_hi) - math.log(kb_lo)) / (MAX_Q - MIN_Q)
+    b = math.log(kb_lo) - a * MIN_Q
+    return max(MIN_Q, min(MAX_Q, math.floor((math.log(target_kb) - b) / a)))
+
+def _encode_to_target(probe_kb: Callable[[int], float], encode: Callable[[int], bytes],
+                      target_kb: int) -> Tuple[bytes, int]:
+    # Sondas con PROBE_METHOD y una codificación con FINAL_METHOD; como el preset final no
+    # comprime igual que el de sonda, mientras se pase del objetivo se baja la calidad.
+    # Desde la segunda corrección la pendiente sale de las codificaciones finales reales
+    q = _pick_quality(probe_kb, target_kb)
+    out = encode(q)
+    last: Optional[Tuple[int, float]] = None
+    while len(out) > target_kb * 1024 and q > MIN_Q:
+        kb = len(out) / 1024
+        step = 3
+        if last is not None and last[1] > kb:
+            a = (math.log(last[1]) - math.log(kb)) / (last[0] - q)
+            step = max(1, math.ceil((math.log(kb) - math.log(target_kb)) / a))
+        last = (q, kb)
+        q = max(MIN_Q, q - step)
+        out = encode(q)
+    return out, q
+
+def _probe_kb(im: Image.Image, q: int, scratch: io.BytesIO) -> float:
+    # Reescribe desde el inicio sin truncar: solo interesa el tamaño (tell), no los bytes
+    scratch.seek(0)
+    im.save(scratch, format="WEBP", quality=q, method=PROBE_METHOD)
+    return scratch.tell() / 1024
+
+def _to_webp_vips(img_buf: io.BytesIO, target_kb: int, max_dim: int) -> Tuple[bytes, int]:
+    # thumbnail_buffer reduce ya al decodificar (shrink-on-load de JPEG/WebP) y nunca
+    # materializa la imagen a resolución completa; respeta la orientación EXIF
+    vi = pyvips.Image.thumbnail_buffer(img_buf.getvalue(), max_dim, height=max_dim, size="down")
+    if vi.interpretation != "srgb":
+        vi = vi.colourspace("srgb")
+    # libvips es perezoso: sin copy_memory cada sonda repetiría decodificación y resize
+    vi = vi.copy_memory()
+    if vi.hasalpha() and vi.extract_band(vi.bands - 1).min() == 255:
+        vi = vi.extract_band(0, n=vi.bands - 1).copy_memory()  # alfa totalmente opaco
+    return _encode_to_target(
+        lambda q: len(vi.write_to_buffer(".webp", Q=q, effort=PROBE_METHOD, strip=True)) / 1024,
+        lambda q: vi.write_to_buffer(".webp", Q=q, effort=FINAL_METHOD, alpha_q=min(q + 10, 100) if vi.hasalpha() else 100, strip=True),
+        target_kb,
+    )
+
+def _libwebp_picture(im: Image.Image) -> "webp.WebPPicture":
+    # Importa los píxeles una sola vez y directamente a YUV (use_argb=0): sin el búfer ARGB
+    # intermedio de from_pil/numpy, y todas las sondas reutilizan los mismos planos
+    ptr = webp.ffi.new("WebPPicture*")
+    if not webp.lib.WebPPictureInit(ptr):
+        raise RuntimeError("libwebp: versión incompatible")
+    ptr.width, ptr.height = im.size
+    ptr.use_argb = 0
+    raw = im.tobytes()
+    import_fn = webp.lib.WebPPictureImportRGBA if im.mode == "RGBA" else webp.lib.WebPPictureImportRGB
+    if not import_fn(ptr, webp.ffi.cast("uint8_t*", webp.ffi.from_buffer(raw)), im.width * len(im.mode)):
+        raise MemoryError("libwebp: sin memoria para importar la imagen")
+    return webp.WebPPicture(ptr)
+
+def _encode_libwebp(im: Image.Image, target_kb: int) -> Tuple[bytes, int]:
+    pic = _libwebp_picture(im)
+
+    def _encode(q: int, method: int):
+        config = webp.WebPConfig.new(preset=webp.WebPPreset.DEFAULT, quality=q, method=method)
+        if im.mode == "RGBA":
+            config.ptr.alpha_quality = min(q + 10, 100)
+        return pic.encode(config)
+
+    def _final(q: int) -> bytes:
+        data = _encode(q, FINAL_METHOD)
+        return bytes(data.buffer())
+
+    return _encode_to_target(lambda q: _encode(q, PROBE_METHOD).size / 1024, _final, target_kb)
+
+def to_webp_optimized(img_buf: io.BytesIO, target_kb: int, max_dim: int) -> Tuple[bytes, int]:
+    # Un WebP que ya cabe en el objetivo y en max_dim se devuelve tal cual (calidad -1).
+    # Image.open solo lee la cabecera. Con EXIF se recodifica igualmente para no publicar
+    # orientación ni GPS que la recodificación descarta; los animados también
+    if img_buf.getbuffer().nbytes <= target_kb * 1024:
+        img_buf.seek(0)
+        with Image.open(img_buf) as im:
+            if (im.format == "WEBP" and max(im.size) <= max_dim
+                    and not getattr(im, "is_animated", False) and not im.info.get("exif")):
+                return img_buf.getvalue(), -1
+    if pyvips is not None:
+        return _to_webp_vips(img_buf, target_kb, max_dim)
+    img_buf.seek(0)
+    im = Image.open(img_buf)
+    if im.format in ("JPEG", "MPO") and max(im.size) > max_dim:
+        # libjpeg decodifica a 1/2, 1/4 o 1/8 en el dominio DCT; pedimos el doble del
+        # tamaño final para que LANCZOS siga teniendo margen. MPO es el JPEG de muchas
+        # cámaras de móvil (imagen principal + vistas previas) y admite lo mismo
+        scale = max_dim / float(max(im.size))
+        im.draft("RGB", (int(im.width * scale) * 2, int(im.height * scale) * 2))
+    # exif_transpose copia la imagen entera incluso con orientación normal (1): solo si hace falta
+    if im.getexif().get(0x0112, 1) != 1:
+        im = ImageOps.exif_transpose(im)
+    # L y CMYK admiten LANCZOS directamente: se convierten a RGB después de reducir, sobre
+    # menos píxeles. El resto de modos (P, 1, I;16…) hay que convertirlos antes
+    if im.mode not in ("RGB", "RGBA", "L", "CMYK"):
         im = im.convert("RGB")
     w, h = im.size
     m = max(w, h)
     if m > max_dim:
         scale = max_dim / float(m)
-        im = im.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-    low, high = MIN_Q, MAX_Q
-    best_buf, best_q = None, MIN_Q
-    for _ in range(10):
-        q = (low + high) // 2
+        im = im.resize((int(w * scale), int(h * scale)), Image.LANCZOS, reducing_gap=3.0)
+    # Un canal alfa totalmente opaco (PNG exportados "con transparencia" sin usarla) solo
+    # añade un plano más a cada sonda: se quita una vez aquí. Con transparencia real se conserva
+    if im.mode not in ("RGB", "RGBA") or (im.mode == "RGBA" and im.getchannel("A").getextrema() == (255, 255)):
+        im = im.convert("RGB")
+    if webp is not None:
+        return _encode_libwebp(im, target_kb)
+    scratch = io.BytesIO(bytes(target_kb * 1024 * 3))  # preasignado para todas las sondas
+
+    def _encode(q: int) -> bytes:
+        extra = {"alpha_quality": min(q + 10, 100)} if im.mode == "RGBA" else {}
         buf = io.BytesIO()
-        im.save(buf, format="WEBP", quality=q, method=6, optimize=True)
-        size_kb = buf.tell() / 1024
-        if size_kb <= target_kb:
-            best_buf, best_q = buf, q
-            low = q + 1
-        else:
-            high = q - 1
-    if best_buf is None:
-        best_buf = io.BytesIO()
-        im.save(best_buf, format="WEBP", quality=MIN_Q, method=6, optimize=True)
-        best_q = MIN_Q
-    best_buf.seek(0)
-    return best_buf, best_q
+        im.save(buf, format="WEBP", quality=q, method=FINAL_METHOD, lossless=False, exact=False, **extra)
+        return buf.getvalue()
+
+    return _encode_to_target(lambda q: _probe_kb(im, q, scratch), _encode, target_kb)
+
+def warm_up() -> None:
+    # Primer uso de Pillow/libwebp (o libvips) en un worker: registro de plugins y dlopen
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64)).save(buf, format="JPEG")
+    to_webp_optimized(buf, 50, 64)
+
+@lru_cache(maxsize=1)
+def make_encoder(cfg: Cfg) -> Callable[[io.BytesIO], Tuple[bytes, int]]:
+    # Codificador especializado para la configuración vigente: Cfg es inmutable y hashable,
+    # así que /settarget y /setmaxdim lo invalidan solos. partial y no un cierre porque
+    # el pool de procesos tiene que poder serializarlo
+    return partial(to_webp_optimized, target_kb=cfg.target_kb, max_dim=cfg.max_dim)
+
+# (hash blake2b del original, target_kb, max_dim) -> (webp, calidad). Vive en el proceso
+# principal: cada worker del pool tendría su propia copia y casi nunca acertaría
+WEBP_CACHE: "OrderedDict[Tuple[str, int, int], Tuple[bytes, int]]" = OrderedDict()
+
+async def _run_encoder(raw: io.BytesIO, cfg: Cfg) -> Tuple[bytes, int]:
+    global EXECUTOR
+    pool = EXECUTOR
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, make_encoder(cfg), raw)
+    except BrokenProcessPool:
+        # Un worker murió (p. ej. OOM decodificando) y el pool queda inservible para siempre:
+        # se sustituye (una sola vez aunque fallen varias imágenes a la vez) y se reintenta
+        if EXECUTOR is pool:
+            log.warning("Pool de codificación roto, se recrea")
+            pool.shutdown(wait=False, cancel_futures=True)
+            EXECUTOR = ProcessPoolExecutor(max_workers=ENCODE_WORKERS)
+        return await asyncio.get_running_loop().run_in_executor(EXECUTOR, make_encoder(cfg), raw)
+
+async def encode_webp(raw: io.BytesIO, cfg: Cfg) -> Tuple[bytes, int]:
+    # hashlib suelta el GIL con buffers grandes: hashear varios MB en un hilo no frena el loop
+    digest = await asyncio.to_thread(lambda: hashlib.blake2b(raw.getbuffer(), digest_size=16).hexdigest())
+    key = (digest, cfg.target_kb, cfg.max_dim)
+    if (hit := WEBP_CACHE.get(key)) is not None:
+        WEBP_CACHE.move_to_end(key)
+        return hit
+    result = await _run_encoder(raw, cfg)
+    WEBP_CACHE[key] = result
+    if len(WEBP_CACHE) > WEBP_CACHE_SIZE:
+        WEBP_CACHE.popitem(last=False)
+    return result
 
 # -------- Álbumes --------
-@dataclass
+# slots: sin __dict__ por instancia (hasta MAX_ALBUMS vivos a la vez); requiere Python 3.10+
+@dataclass(slots=True)
 class AlbumBuffer:
     media_group_id: str
     chat_id: int
     caption: str = ""
     message_ids: List[int] = field(default_factory=list)
-    items: List[bytes] = field(default_factory=list)  # webp bytes
+    items: List[io.BytesIO] = field(default_factory=list)  # imágenes originales, se codifican al finalizar
     last_update: float = field(default_factory=lambda: time.time())
+    total_bytes: int = 0  # tamaño acumulado de los originales
+    pending: int = 0  # descargas en curso; no se finaliza mientras haya alguna
+    reply_target: Any = None  # último mensaje del álbum, para responder
     finalized: bool = False  # evita doble finalización y limpieza prematura
 
-ALBUMS: Dict[str, AlbumBuffer] = {}
+# Orden de inserción = antigüedad: al superar MAX_ALBUMS se descarta el más viejo.
+# Todo acceso ocurre en el hilo del event loop sin awaits intermedios, así que no hace falta lock
+ALBUMS: "OrderedDict[str, AlbumBuffer]" = OrderedDict()
 FINALIZE_TASKS: Dict[str, asyncio.Task] = {}
 
+# Se crean en post_init: cada reintento de main() arranca un event loop nuevo
+HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+DOWNLOAD_SEM: Optional[asyncio.Semaphore] = None
+SWEEPER_TASK: Optional[asyncio.Task] = None
+REDIS = None  # cliente redis.asyncio si hay REDIS_URL
+
+async def bump_stats(processed: int, saved_bytes: int) -> None:
+    stats["processed"] += processed
+    stats["saved_bytes"] += saved_bytes
+    if REDIS:
+        try:
+            async with REDIS.pipeline(transaction=False) as pipe:
+                pipe.incrby("stats:processed", processed)
+                pipe.incrby("stats:saved_bytes", saved_bytes)
+                await pipe.execute()
+        except Exception as e:
+            log.warning(f"No se pudieron guardar estadísticas en Redis: {e}")
+
+def _sniff_format(buf: io.BytesIO) -> Optional[str]:
+    # Image.open solo lee la cabecera; con lo descargado hasta ahora basta para identificarla.
+    # Solo sobre los bytes recibidos (hasta tell): el resto del buffer preasignado son ceros,
+    # y un segmento EXIF/ICC más largo que lo recibido haría al parser JPEG recorrerlos byte
+    # a byte en vez de encontrar EOF
+    with buf.getbuffer() as view, view[:buf.tell()] as head:
+        received = io.BytesIO(head)
+    try:
+        with Image.open(received) as im:
+            return im.format
+    except Exception:
+        return None
+
+async def download_image(file) -> io.BytesIO:
+    """Descarga en streaming por la sesión compartida e identifica la imagen con los
+    primeros chunks; la decodificación completa sigue en el pool de procesos."""
+    # Con el tamaño conocido se reserva el buffer de una vez: los chunks se escriben encima
+    # en vez de ir creciendo el BytesIO con una realocación tras otra
+    src = io.BytesIO(bytes(min(file.file_size or 0, MAX_UPLOAD_BYTES)))
+    fmt = None
+    async with DOWNLOAD_SEM, HTTP_SESSION.get(file.file_path) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"descarga HTTP {resp.status}")
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            src.write(chunk)
+            if src.tell() > MAX_UPLOAD_BYTES:
+                raise ValueError(f"Imagen demasiado grande (>{MAX_UPLOAD_BYTES // (1024 * 1024)}MB).")
+            if fmt is None:
+                # Sin cabecera reconocible en los primeros 512KB se corta la descarga
+                if src.tell() > 512 * 1024:
+                    break
+                fmt = _sniff_format(src)
+    src.truncate()
+    if fmt is None and (fmt := _sniff_format(src)) is None:
+        raise ValueError("El archivo no es una imagen reconocible.")
+    return src
+
 async def upload_webp_bytes(webp_bytes: bytes, path: str) -> None:
     def _upload():
         blob = bucket.blob(path)
         blob.cache_control = "public, max-age=31536000, immutable"
-        blob.upload_from_file(io.BytesIO(webp_bytes), content_type="image/webp")
-    await asyncio.to_thread(_upload)
+        # Una sola petición multipart. if_generation_match=0 solo crea el objeto si no existe
+        # (sin exists() previo) y además hace la subida reintentable; sin MD5 en cliente
+        try:
+            blob.upload_from_string(webp_bytes, content_type="image/webp", checksum=None, if_generation_match=0)
+        except PreconditionFailed:
+            pass  # rutas direccionadas por contenido: ya existe con los mismos bytes
+    await asyncio.get_running_loop().run_in_executor(UPLOAD_POOL, _upload)
 
 async def finalize_and_send(draft_id: str, album: AlbumBuffer, reply_target):
     log.info(f"Finalizando álbum mgid={album.media_group_id} con {len(album.items)} imágenes")
-    images = []
-    for idx, data in enumerate(album.items):
-        storage_path = f"drafts/{draft_id}/images/{idx:02d}.webp"
-        await upload_webp_bytes(data, storage_path)
-        images.append({"storagePath": storage_path, "index": idx})
+    cfg = CFG  # misma configuración para todo el álbum aunque cambie a mitad
+
+    # Cada imagen se sube en cuanto termina su codificación, sin esperar al resto del álbum
+    async def _process(idx: int, raw: io.BytesIO) -> Tuple[str, int]:
+        webp_bytes, used_q = await encode_webp(raw, cfg)
+        path = f"drafts/content/{hashlib.blake2b(webp_bytes, digest_size=16).hexdigest()}.webp"
+        await upload_webp_bytes(webp_bytes, path)
+        before, after = len(raw.getbuffer()), len(webp_bytes)
+        log.info(f"Imagen {idx} mgid={album.media_group_id} q={used_q} size~{after//1024}KB")
+        return path, max(before - after, 0)
+
+    # Una imagen que no se puede decodificar (p. ej. JPEG truncado) se descarta sola y el
+    # borrador sigue con el resto; solo falla entero si no queda ninguna
+    results = await asyncio.gather(*[_process(idx, raw) for idx, raw in enumerate(album.items)], return_exceptions=True)
+    done: List[Tuple[str, int]] = []
+    failed: List[int] = []
+    for idx, res in enumerate(results):
+        if isinstance(res, BaseException):
+            log.error(f"Imagen {idx} mgid={album.media_group_id} descartada: {res!r}")
+            failed.append(idx + 1)
+        else:
+            done.append(res)
+    if not done:
+        raise results[0]
+    await bump_stats(len(done), sum(saved for _, saved in done))
+    images = [{"storagePath": path, "index": idx} for idx, (path, _) in enumerate(done)]
 
     payload = {
         "draftId": draft_id,
@@ -151,34 +444,62 @@ async def finalize_and_send(draft_id: str, album: AlbumBuffer, reply_target):
         "images": images
     }
     log.info(f"POST {API_DRAFTS_IMPORT_URL} con {len(images)} imágenes")
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120)) as session:
-        async with session.post(
-            API_DRAFTS_IMPORT_URL,
-            headers={"X-Ingest-Token": X_INGEST_TOKEN, "Content-Type": "application/json"},
-            json=payload
-        ) as resp:
-            text = await resp.text()
-            if resp.status != 200:
-                log.error(f"Ingest falló HTTP {resp.status}: {text}")
-                raise RuntimeError(f"ingest HTTP {resp.status}: {text}")
-            try:
-                data = json.loads(text)
-            except Exception:
-                data = {}
-            draft_id_resp = data.get("draftId", draft_id)
-            slug_suggested = data.get("slugSuggested")
+    async with HTTP_SESSION.post(
+        API_DRAFTS_IMPORT_URL,
+        headers={"X-Ingest-Token": X_INGEST_TOKEN, "Content-Type": "application/json"},
+        data=orjson.dumps(payload)
+    ) as resp:
+        text = await resp.text()
+        if resp.status != 200:
+            log.error(f"Ingest falló HTTP {resp.status}: {text}")
+            raise RuntimeError(f"ingest HTTP {resp.status}: {text}")
+        try:
+            data = orjson.loads(text)
+        except Exception:
+            data = {}
+        draft_id_resp = data.get("draftId", draft_id)
+        slug_suggested = data.get("slugSuggested")
 
     await reply_target.reply_text(
         f"📝 Borrador creado: {draft_id_resp}\n"
         f"Slug sugerido: {slug_suggested or '—'}\n"
         f"Revisar en /admin/productos/borradores"
+        + (f"\n⚠️ Imágenes descartadas (no se pudieron procesar): {', '.join(map(str, failed))}" if failed else "")
     )
 
+async def _finalize_album(mgid: str, album: AlbumBuffer):
+    try:
+        await finalize_and_send(str(uuid.uuid4()), album, album.reply_target)
+    except Exception as e:
+        log.exception("Error finalizando álbum")
+        try:
+            await album.reply_target.reply_text(f"❌ Error creando borrador: {e}")
+        except Exception:
+            pass
+    finally:
+        FINALIZE_TASKS.pop(mgid, None)
+
+def _spawn_finalize(mgid: str, album: AlbumBuffer) -> None:
+    album.finalized = True
+    ALBUMS.pop(mgid, None)
+    if album.items and album.reply_target:
+        FINALIZE_TASKS[mgid] = asyncio.create_task(_finalize_album(mgid, album))
+
+async def album_sweeper():
+    """Única tarea de debounce: cada 0.5s cierra los álbumes sin novedades en ALBUM_TTL_SEC."""
+    while True:
+        await asyncio.sleep(0.5)
+        now = time.time()
+        for mgid, album in list(ALBUMS.items()):
+            if album.finalized or album.pending or (now - album.last_update) < ALBUM_TTL_SEC:
+                continue
+            _spawn_finalize(mgid, album)
+
 # -------- Handlers --------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text(
         "👋 Listo. Envía un álbum con caption (Nombre, Descripción, Tallas, Precio, Categoría).\n"
-        f"Optimizo a WebP ~{TARGET_KB}KB, máx {MAX_DIM}px y creo un borrador en la web."
+        f"Optimizo a WebP ~{CFG.target_kb}KB, máx {CFG.max_dim}px y creo un borrador en la web."
     )
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -187,31 +508,38 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def settarget(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_authorized(update, context):
         return await update.effective_message.reply_text("Solo admins.")
-    global TARGET_KB
+    global CFG
     try:
         kb = int(context.args[0]); assert 50 <= kb <= 2000
-        TARGET_KB = kb
-        await update.effective_message.reply_text(f"TARGET_KB = {TARGET_KB} KB ✅")
+        CFG = replace(CFG, target_kb=kb)
+        await update.effective_message.reply_text(f"TARGET_KB = {CFG.target_kb} KB ✅")
     except Exception:
         await update.effective_message.reply_text("Uso: /settarget 50..2000")
 
 async def setmaxdim(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_authorized(update, context):
         return await update.effective_message.reply_text("Solo admins.")
-    global MAX_DIM
+    global CFG
     try:
         px = int(context.args[0]); assert 256 <= px <= 8192
-        MAX_DIM = px
-        await update.effective_message.reply_text(f"MAX_DIMENSION = {MAX_DIM}px ✅")
+        CFG = replace(CFG, max_dim=px)
+        await update.effective_message.reply_text(f"MAX_DIMENSION = {CFG.max_dim}px ✅")
     except Exception:
         await update.effective_message.reply_text("Uso: /setmaxdim 256..8192")
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_authorized(update, context):
         return await update.effective_message.reply_text("Solo admins.")
-    saved_mb = stats["saved_bytes"] / (1024 * 1024) if stats["saved_bytes"] else 0
+    processed, saved_bytes = stats["processed"], stats["saved_bytes"]
+    if REDIS:
+        try:
+            values = await REDIS.mget("stats:processed", "stats:saved_bytes")
+            processed, saved_bytes = (int(v or 0) for v in values)
+        except Exception as e:
+            log.warning(f"No se pudieron leer estadísticas de Redis: {e}")
+    saved_mb = saved_bytes / (1024 * 1024) if saved_bytes else 0
     await update.effective_message.reply_text(
-        f"📊 Procesadas: {stats['processed']}\n💾 Ahorro: ~{saved_mb:.2f} MB"
+        f"📊 Procesadas: {processed}\n💾 Ahorro: ~{saved_mb:.2f} MB"
     )
 
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -224,64 +552,97 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     mgid = msg.media_group_id or f"single_{msg.message_id}"
     album = ALBUMS.get(mgid)
+    evicted = None
     if not album:
         album = ALBUMS[mgid] = AlbumBuffer(media_group_id=mgid, chat_id=chat.id)
         log.info(f"Nuevo grupo mgid={mgid}")
+        if len(ALBUMS) > MAX_ALBUMS:
+            old_mgid, evicted = ALBUMS.popitem(last=False)
+            evicted.finalized = True
+            log.warning(f"Demasiados álbumes en curso: descartado mgid={old_mgid} ({len(evicted.items)} imágenes)")
+    if len(album.items) >= MAX_ALBUM_ITEMS or album.total_bytes >= MAX_ALBUM_BYTES:
+        log.warning(f"Álbum lleno mgid={mgid}: ignorada imagen {msg.message_id}")
+        return await msg.reply_text(
+            f"❌ Álbum lleno (máx {MAX_ALBUM_ITEMS} imágenes, {MAX_ALBUM_BYTES // (1024 * 1024)}MB): "
+            f"esta imagen no entra en el borrador."
+        )
     album.last_update = time.time()
+    album.reply_target = msg
     album.message_ids.append(msg.message_id)
     if msg.caption and not album.caption:
         album.caption = msg.caption
         log.info(f"Caption (mgid={mgid}): {album.caption[:200]}")
 
-    file = None
-    if msg.photo:
-        file = await msg.photo[-1].get_file()
-    elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("image/"):
-        file = await msg.document.get_file()
-    else:
-        return
-
-    src = io.BytesIO()
-    await file.download_to_memory(out=src)
-    before = src.tell()
-    webp_buf, used_q = to_webp_optimized(src.getvalue(), TARGET_KB, MAX_DIM)
-    after = len(webp_buf.getbuffer())
-    stats["processed"] += 1
-    if before > after:
-        stats["saved_bytes"] += (before - after)
-    album.items.append(webp_buf.getvalue())
-    log.info(f"Imagen añadida mgid={mgid} q={used_q} size~{after//1024}KB total={len(album.items)}")
-
-    if task := FINALIZE_TASKS.get(mgid):
-        task.cancel()
-
-    async def _debounce_finalize():
-        finalized_local = False
+    if evicted is not None and evicted.reply_target:
         try:
-            await asyncio.sleep(ALBUM_TTL_SEC)
-            album_ref = ALBUMS.get(mgid)
-            if album_ref and (not album_ref.finalized) and (time.time() - album_ref.last_update) >= (ALBUM_TTL_SEC - 0.1):
-                album_ref.finalized = True
-                finalized_local = True
-                draft_id = str(uuid.uuid4())
-                await finalize_and_send(draft_id, album_ref, msg)
-        except asyncio.CancelledError:
-            # Se canceló por llegada de nueva parte del álbum: no limpiar estado
+            await evicted.reply_target.reply_text("❌ Demasiados álbumes en curso: este se descartó, reenvíalo.")
+        except Exception:
             pass
-        except Exception as e:
-            log.exception("Error finalizando álbum")
-            try:
-                await msg.reply_text(f"❌ Error creando borrador: {e}")
-            except Exception:
-                pass
-        finally:
-            FINALIZE_TASKS.pop(mgid, None)
-            if finalized_local:
-                ALBUMS.pop(mgid, None)
-
-    # Solo programa si el álbum no ha sido finalizado ya
-    if not ALBUMS[mgid].finalized:
-        FINALIZE_TASKS[mgid] = context.application.create_task(_debounce_finalize())
+
+    album.pending += 1
+    try:
+        if msg.photo:
+            media = msg.photo[-1]
+        elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("image/"):
+            media = msg.document
+        else:
+            return
+        # file_size viene en el update: rechazar sin descargar nada
+        if media.file_size and media.file_size > MAX_UPLOAD_BYTES:
+            log.warning(f"Descartada mgid={mgid}: {media.file_size} bytes")
+            return await msg.reply_text(f"❌ Imagen demasiado grande (>{MAX_UPLOAD_BYTES // (1024 * 1024)}MB).")
+        file = await media.get_file()
+
+        try:
+            src = await download_image(file)
+        except ValueError as e:
+            log.warning(f"Descartada mgid={mgid}: {e}")
+            return await msg.reply_text(f"❌ {e}")
+        album.items.append(src)
+        album.total_bytes += src.tell()
+        # Aunque llegue a MAX_ALBUM_BYTES no se cierra antes del TTL: las partes que faltan
+        # crearían un segundo borrador sin caption; se rechazan con aviso como "Álbum lleno"
+        album.last_update = time.time()
+        log.info(f"Imagen añadida mgid={mgid} size~{src.tell()//1024}KB total={len(album.items)}")
+    finally:
+        album.pending -= 1
+
+async def post_init(app):
+    global HTTP_SESSION, DOWNLOAD_SEM, SWEEPER_TASK, REDIS
+    # Sesión compartida: reutiliza TCP+TLS entre álbumes en vez de un handshake por borrador
+    HTTP_SESSION = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=120),
+        # DNS cacheado 5 min: api.telegram.org y la web de ingest no cambian entre álbumes
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60, ttl_dns_cache=300),
+    )
+    # Descargas simultáneas acotadas: la memoria en vuelo queda en ~8 x MAX_UPLOAD_BYTES
+    DOWNLOAD_SEM = asyncio.Semaphore(8)
+    SWEEPER_TASK = asyncio.create_task(album_sweeper())
+    if REDIS_URL:
+        REDIS = aioredis.from_url(REDIS_URL)
+
+async def post_stop(app):
+    global SWEEPER_TASK
+    if SWEEPER_TASK:
+        SWEEPER_TASK.cancel()
+        SWEEPER_TASK = None
+    # Application.stop() no conoce estas tareas: los álbumes ya recibidos se cierran ya y se
+    # esperan todos los borradores en curso. Aquí y no en post_shutdown porque shutdown()
+    # cierra el cliente HTTP del bot y las respuestas al usuario fallarían
+    for mgid, album in list(ALBUMS.items()):
+        if not album.finalized:
+            _spawn_finalize(mgid, album)
+    if FINALIZE_TASKS:
+        await asyncio.gather(*FINALIZE_TASKS.values(), return_exceptions=True)
+
+async def post_shutdown(app):
+    global HTTP_SESSION, REDIS
+    if HTTP_SESSION:
+        await HTTP_SESSION.close()
+        HTTP_SESSION = None
+    if REDIS:
+        await REDIS.aclose()
+        REDIS = None
 
 def build_app():
     app = (
@@ -289,6 +650,7 @@ def build_app():
         .token(BOT_TOKEN)
         .connect_timeout(30).read_timeout(60).write_timeout(60)
         .pool_timeout(30).get_updates_read_timeout(70)
+        .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
         .build()
     )
     app.add_handler(CommandHandler("start", start))
@@ -299,7 +661,25 @@ def build_app():
     app.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_media))
     return app
 
+def warm_gcs() -> None:
+    # Token OAuth y conexión TLS de gcs_client listos antes del primer álbum. Aunque la SA no
+    # pueda leer metadatos del bucket (403), el token y la conexión quedan igualmente hechos
+    try:
+        bucket.reload()
+    except Exception as e:
+        log.warning(f"Precalentando GCS: {e}")
+
 def main():
+    # El pool primero: sus workers se bifurcan de este proceso, y el estado de libvips (con su
+    # pool de hilos nativo) no sobrevive al fork. Aquí nunca se codifica, solo se identifican
+    # cabeceras con Pillow: basta con registrar sus plugins, sin tocar pyvips
+    for f in [EXECUTOR.submit(warm_up) for _ in range(ENCODE_WORKERS)]:
+        f.result()
+    Image.init()
+    warm_gcs()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        log.info("Usando uvloop")
     backoff = 5
     while True:
         app = build_app()